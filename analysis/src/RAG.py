@@ -1,20 +1,41 @@
+import asyncio
 import json
 import os
 import sys
+import uuid
 import argparse
 from typing import Dict, List, Any, TypedDict
 
 from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
 
 from langgraph.graph import StateGraph
 
 from dotenv import load_dotenv
 
-from utils.embedding_generator import generate_embeddings, sanitize_filename
+from utils.embedding_generator import (
+    discard_index,
+    generate_embeddings,
+    get_index_max_age_hours,
+    get_index_paths,
+    index_exists,
+    load_sampling_stats,
+    sanitize_filename,
+)
+from utils.llm_client import LLMBudgetExceeded, get_llm_client
+from utils.metrics import (
+    ANALYSIS_JOBS,
+    INDEX_LOAD_LATENCY,
+    INDEX_LOADS,
+    STAGE_LATENCY,
+    dump_metrics,
+)
+from utils.hybrid_retriever import (
+    HybridRetriever,
+    QueryEmbeddingCache,
+    format_documents,
+)
 
 
 # Helper for debug logging to stderr
@@ -29,7 +50,53 @@ def debug_log(message: str):
 current_dir = os.path.dirname(os.path.abspath(__file__))
 env_path = os.path.join(current_dir, ".env")
 load_dotenv(dotenv_path=env_path)
-api_key = os.getenv("GOOGLE_API_KEY")
+
+
+# Aspect queries issued together against each index and fused with RRF
+PRODUCT_ASPECT_QUERIES = [
+    "product features and specifications",
+    "build quality and durability",
+    "price and value for money",
+    "comfort, fit and ease of use",
+    "defects, malfunctions and broken parts",
+    "customer complaints and returns",
+    "what customers love about the product",
+]
+COMPETITOR_ASPECT_QUERIES = [
+    "competitor features and specifications",
+    "competitor advantages and strengths",
+    "build quality and durability",
+    "price and value for money",
+    "comfort, fit and ease of use",
+    "defects, malfunctions and broken parts",
+    "customer complaints and returns",
+]
+PRODUCT_RETRIEVAL_K = 10
+COMPETITOR_RETRIEVAL_K = 12
+
+_query_cache = None
+
+
+def get_query_cache(data_dir: str) -> QueryEmbeddingCache:
+    """Return the shared on-disk cache of aspect query embeddings."""
+    global _query_cache
+    if _query_cache is None:
+        _query_cache = QueryEmbeddingCache(
+            os.path.join(data_dir, "query_embeddings.json"),
+            embedding_model.model_name,
+        )
+    return _query_cache
+
+
+def retrieve_context(
+    index, index_path: str, data_dir: str, queries: List[str], k: int
+) -> str:
+    """Run hybrid retrieval for the aspect queries and format the results.
+    Blocking (embedding, FAISS and BM25 search), so nodes call it in a thread."""
+    retriever = HybridRetriever(
+        index, index_path, embedding_model, get_query_cache(data_dir), k=k
+    )
+    return format_documents(retriever.invoke(queries))
 
 
 # Define the state for our graph
@@ -40,20 +107,26 @@ class AnalysisState(TypedDict):
     final_report: str
     asin: str  # Added to track the product ASIN
     keyword: str  # Added to track the search keyword
+    job_id: str  # Key for per-job LLM usage accounting
 
 
 # Functions to load FAISS indices
-import shutil
-
-
 def load_faiss_index(index_path: str, force_rebuild=False, asin=None, keyword=None):
     """Load a pre-built FAISS index, with dangerous deserialization allowed (safe for local trusted files). If loading fails, optionally auto-rebuild."""
+    loaded_mtime = None
     try:
         debug_log(f"Loading FAISS index: {index_path}")
-        return FAISS.load_local(
-            index_path, embedding_model, allow_dangerous_deserialization=True
-        )
+        # Waits out an index swap instead of failing and rebuilding
+        index_exists(index_path)
+        loaded_mtime = os.path.getmtime(index_path)
+        with INDEX_LOAD_LATENCY.time():
+            index = FAISS.load_local(
+                index_path, embedding_model, allow_dangerous_deserialization=True
+            )
+        INDEX_LOADS.inc(result="success")
+        return index
     except Exception as e:
+        INDEX_LOADS.inc(result="failure")
         print(
             f"[ERROR] Failed to load FAISS index from {index_path}: {str(e)}",
             file=sys.stderr,
@@ -64,8 +137,8 @@ def load_faiss_index(index_path: str, force_rebuild=False, asin=None, keyword=No
                 file=sys.stderr,
             )
             try:
-                if os.path.exists(index_path):
-                    shutil.rmtree(index_path)
+                # Under the index lock, and only if no other process rebuilt it meanwhile
+                discard_index(index_path, loaded_mtime)
             except Exception as del_e:
                 print(
                     f"[ERROR] Failed to delete vectorstore {index_path}: {del_e}",
@@ -77,12 +150,16 @@ def load_faiss_index(index_path: str, force_rebuild=False, asin=None, keyword=No
             if regen_success:
                 try:
                     debug_log(f"Retrying FAISS load after regeneration: {index_path}")
-                    return FAISS.load_local(
-                        index_path,
-                        embedding_model,
-                        allow_dangerous_deserialization=True,
-                    )
+                    with INDEX_LOAD_LATENCY.time():
+                        index = FAISS.load_local(
+                            index_path,
+                            embedding_model,
+                            allow_dangerous_deserialization=True,
+                        )
+                    INDEX_LOADS.inc(result="rebuilt")
+                    return index
                 except Exception as e2:
+                    INDEX_LOADS.inc(result="failure")
                     print(
                         f"[ERROR] Still failed to load FAISS after regeneration: {e2}",
                         file=sys.stderr,
@@ -96,29 +173,34 @@ def load_faiss_index(index_path: str, force_rebuild=False, asin=None, keyword=No
 
 
 # Node 1: Product Analysis (only considers the product's own data)
-def analyze_product(state: AnalysisState, force_rebuild=False) -> AnalysisState:
+async def analyze_product(
+    state: AnalysisState, force_rebuild=False
+) -> AnalysisState:
     asin = state["asin"]
     keyword = state["keyword"]
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(current_dir, ".."))
     data_dir = os.path.join(project_root, "data")
-    product_index_path = os.path.join(data_dir, f"{asin}_faiss")
-    product_index = load_faiss_index(
-        product_index_path, force_rebuild=force_rebuild, asin=asin, keyword=keyword
+    product_index_path, _ = get_index_paths(asin, keyword)
+    # Index loading (and a possible rebuild) blocks, so keep it off the event loop
+    product_index = await asyncio.to_thread(
+        load_faiss_index, product_index_path, force_rebuild, asin, keyword
     )
     if not product_index:
         state["product_analysis"] = (
             f"Error: Could not load product index for ASIN {asin}."
         )
         return state
-    retriever = product_index.as_retriever(search_kwargs={"k": 5})
-    product_context = retriever.invoke(
-        "product features, specifications, customer reviews"
+    product_context = await asyncio.to_thread(
+        retrieve_context,
+        product_index,
+        product_index_path,
+        data_dir,
+        PRODUCT_ASPECT_QUERIES,
+        PRODUCT_RETRIEVAL_K,
     )
     debug_log(f"Product context for LLM: {product_context}")
-    if not product_context or (
-        isinstance(product_context, list) and not product_context
-    ):
+    if not product_context:
         state["product_analysis"] = "Error: No product context available for analysis."
         return state
     product_analysis_prompt = ChatPromptTemplate.from_template(
@@ -135,11 +217,11 @@ def analyze_product(state: AnalysisState, force_rebuild=False) -> AnalysisState:
         Provide a detailed analysis that helps understand the product's strengths and weaknesses.
         """
     )
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash", google_api_key=api_key, temperature=0
+    llm_client = get_llm_client()
+    product_analysis = await llm_client.ainvoke(
+        product_analysis_prompt.format_prompt(context=product_context),
+        job_id=state["job_id"],
     )
-    product_chain = product_analysis_prompt | llm | StrOutputParser()
-    product_analysis = product_chain.invoke({"context": product_context})
     if "Unable to determine" in product_analysis or "Placeholder" in product_analysis:
         print("[WARN] LLM returned placeholder output for product analysis.")
     state["product_analysis"] = product_analysis
@@ -147,33 +229,35 @@ def analyze_product(state: AnalysisState, force_rebuild=False) -> AnalysisState:
 
 
 # Node 2: Competitor Analysis and Suggestions
-def analyze_competitors(state: AnalysisState, force_rebuild=False) -> AnalysisState:
+async def analyze_competitors(
+    state: AnalysisState, force_rebuild=False
+) -> AnalysisState:
     asin = state["asin"]
     keyword = state["keyword"]
-    safe_keyword = sanitize_filename(keyword)
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(current_dir, ".."))
     data_dir = os.path.join(project_root, "data")
-    product_index_path = os.path.join(data_dir, f"{asin}_faiss")
-    competitor_index_path = os.path.join(data_dir, f"{safe_keyword}_faiss")
-    product_index = load_faiss_index(
-        product_index_path, force_rebuild=force_rebuild, asin=asin, keyword=keyword
+    product_index_path, competitor_index_path = get_index_paths(asin, keyword)
+    product_index = await asyncio.to_thread(
+        load_faiss_index, product_index_path, force_rebuild, asin, keyword
     )
-    competitor_index = load_faiss_index(
-        competitor_index_path, force_rebuild=force_rebuild, asin=asin, keyword=keyword
+    competitor_index = await asyncio.to_thread(
+        load_faiss_index, competitor_index_path, force_rebuild, asin, keyword
     )
     if not product_index or not competitor_index:
         state["competitor_analysis"] = "Error: Could not load indices."
         state["suggestions"] = "Error: Could not generate suggestions."
         return state
-    competitor_retriever = competitor_index.as_retriever(search_kwargs={"k": 5})
-    competitor_context = competitor_retriever.invoke(
-        "competitor features, advantages, reviews"
+    competitor_context = await asyncio.to_thread(
+        retrieve_context,
+        competitor_index,
+        competitor_index_path,
+        data_dir,
+        COMPETITOR_ASPECT_QUERIES,
+        COMPETITOR_RETRIEVAL_K,
     )
     debug_log(f"Competitor context for LLM: {competitor_context}")
-    if not competitor_context or (
-        isinstance(competitor_context, list) and not competitor_context
-    ):
+    if not competitor_context:
         state["competitor_analysis"] = (
             "Error: No competitor context available for analysis."
         )
@@ -211,15 +295,13 @@ def analyze_competitors(state: AnalysisState, force_rebuild=False) -> AnalysisSt
         Each suggestion should be specific, practical, and directly tied to insights from the analysis.
         """
     )
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash", google_api_key=api_key, temperature=0
-    )
-    competitor_chain = competitor_analysis_prompt | llm | StrOutputParser()
-    competitor_analysis = competitor_chain.invoke(
-        {
-            "product_analysis": state["product_analysis"],
-            "competitor_context": competitor_context,
-        }
+    llm_client = get_llm_client()
+    competitor_analysis = await llm_client.ainvoke(
+        competitor_analysis_prompt.format_prompt(
+            product_analysis=state["product_analysis"],
+            competitor_context=competitor_context,
+        ),
+        job_id=state["job_id"],
     )
     if (
         "Placeholder" in competitor_analysis
@@ -227,19 +309,19 @@ def analyze_competitors(state: AnalysisState, force_rebuild=False) -> AnalysisSt
     ):
         print("[WARN] LLM returned placeholder output for competitor analysis.")
     state["competitor_analysis"] = competitor_analysis
-    suggestions_chain = suggestions_prompt | llm | StrOutputParser()
-    suggestions = suggestions_chain.invoke(
-        {
-            "product_analysis": state["product_analysis"],
-            "competitor_analysis": state["competitor_analysis"],
-        }
+    suggestions = await llm_client.ainvoke(
+        suggestions_prompt.format_prompt(
+            product_analysis=state["product_analysis"],
+            competitor_analysis=state["competitor_analysis"],
+        ),
+        job_id=state["job_id"],
     )
     state["suggestions"] = suggestions
     return state
 
 
 # Node 3: Final Report Generation
-def generate_final_report(state: AnalysisState) -> AnalysisState:
+async def generate_final_report(state: AnalysisState) -> AnalysisState:
     """Generate a comprehensive final report combining all analyses with structured pros and cons."""
     asin = state["asin"]
     keyword = state["keyword"]
@@ -299,23 +381,18 @@ def generate_final_report(state: AnalysisState) -> AnalysisState:
     """
     )
 
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash",  # Updated model name
-        google_api_key=api_key,
-        temperature=0,
-    )
-
-    final_report_chain = final_report_prompt | llm | StrOutputParser()
+    llm_client = get_llm_client()
 
     # Get the JSON-formatted report
-    json_report = final_report_chain.invoke(
-        {
-            "asin": asin,
-            "keyword": keyword,
-            "product_analysis": state["product_analysis"],
-            "competitor_analysis": state["competitor_analysis"],
-            "suggestions": state["suggestions"],
-        }
+    json_report = await llm_client.ainvoke(
+        final_report_prompt.format_prompt(
+            asin=asin,
+            keyword=keyword,
+            product_analysis=state["product_analysis"],
+            competitor_analysis=state["competitor_analysis"],
+            suggestions=state["suggestions"],
+        ),
+        job_id=state["job_id"],
     )
 
     # --- Clean and parse JSON output ---
@@ -355,43 +432,53 @@ def generate_final_report(state: AnalysisState) -> AnalysisState:
 # Set up the LangGraph
 def build_graph(force_rebuild=False):
     graph = StateGraph(AnalysisState)
-    # Wrap nodes to pass force_rebuild
-    graph.add_node(
-        "analyze_product",
-        lambda state: analyze_product(state, force_rebuild=force_rebuild),
-    )
-    graph.add_node(
-        "analyze_competitors",
-        lambda state: analyze_competitors(state, force_rebuild=force_rebuild),
-    )
-    graph.add_node("generate_final_report", generate_final_report)
+
+    # Wrap nodes to pass force_rebuild and record stage latency
+    # (async wrappers so LangGraph awaits them)
+    async def analyze_product_node(state: AnalysisState) -> AnalysisState:
+        with STAGE_LATENCY.time(stage="analyze_product"):
+            return await analyze_product(state, force_rebuild=force_rebuild)
+
+    async def analyze_competitors_node(state: AnalysisState) -> AnalysisState:
+        with STAGE_LATENCY.time(stage="analyze_competitors"):
+            return await analyze_competitors(state, force_rebuild=force_rebuild)
+
+    async def generate_final_report_node(state: AnalysisState) -> AnalysisState:
+        with STAGE_LATENCY.time(stage="generate_final_report"):
+            return await generate_final_report(state)
+
+    graph.add_node("analyze_product", analyze_product_node)
+    graph.add_node("analyze_competitors", analyze_competitors_node)
+    graph.add_node("generate_final_report", generate_final_report_node)
     graph.add_edge("analyze_product", "analyze_competitors")
     graph.add_edge("analyze_competitors", "generate_final_report")
     graph.set_entry_point("analyze_product")
     return graph.compile()
 
 
-def main(asin: str, keyword: str, output_json=True, force_rebuild=False):
+def main(asin: str, keyword: str, output_json=True, force_rebuild=False) -> bool:
     """Main function to run the analysis process."""
+    success = False
+    try:
+        with STAGE_LATENCY.time(stage="job"):
+            success = run_analysis(asin, keyword, output_json, force_rebuild)
+    finally:
+        ANALYSIS_JOBS.inc(status="success" if success else "failed")
+    return success
+
+
+def run_analysis(asin: str, keyword: str, output_json=True, force_rebuild=False) -> bool:
+    """Run embeddings and the analysis graph; returns True if a report was produced."""
     if not output_json:
         print(f"Starting analysis for ASIN: {asin} and keyword: {keyword}")
     global embedding_model
     embedding_model = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en-v1.5")
     if not output_json:
         print("Preparing vector embeddings...")
-    if force_rebuild:
-        # Delete vectorstores if they exist
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        project_root = os.path.abspath(os.path.join(current_dir, ".."))
-        data_dir = os.path.join(project_root, "data")
-        safe_keyword = sanitize_filename(keyword)
-        product_index_path = os.path.join(data_dir, f"{asin}_faiss")
-        competitor_index_path = os.path.join(data_dir, f"{safe_keyword}_faiss")
-        for path in [product_index_path, competitor_index_path]:
-            if os.path.exists(path):
-                debug_log(f"Deleting vectorstore: {path}")
-                shutil.rmtree(path)
-    embedding_success = generate_embeddings(asin, keyword)
+    # --force-rebuild rebuilds only stale vectorstores so fresh (e.g. pre-warmed)
+    # ones are reused; indexes that fail to load are rebuilt by load_faiss_index
+    max_age_hours = get_index_max_age_hours() if force_rebuild else 0
+    embedding_success = generate_embeddings(asin, keyword, max_age_hours)
     if not embedding_success:
         error_msg = "Failed to generate required embeddings. Analysis cannot proceed."
         if not output_json:
@@ -399,7 +486,7 @@ def main(asin: str, keyword: str, output_json=True, force_rebuild=False):
         error_result = {"error": True, "message": error_msg}
         if output_json:
             print(json.dumps(error_result))
-        return
+        return False
     if not output_json:
         print("Embeddings ready. Starting analysis...")
     initial_state: AnalysisState = {
@@ -409,21 +496,42 @@ def main(asin: str, keyword: str, output_json=True, force_rebuild=False):
         "final_report": "",
         "asin": asin,
         "keyword": keyword,
+        # Unique per run so usage (and the token budget) never carries over
+        "job_id": f"{asin}:{keyword}:{uuid.uuid4().hex}",
     }
     graph = build_graph(force_rebuild=force_rebuild)
-    result = graph.invoke(initial_state)
+    try:
+        result = asyncio.run(graph.ainvoke(initial_state))
+    except LLMBudgetExceeded as e:
+        if not output_json:
+            print(f"Error: {e}")
+        error_result = {"error": True, "message": str(e)}
+        if output_json:
+            print(json.dumps(error_result))
+        return False
+    finally:
+        # Drop the job's usage entry so long-running workers don't accumulate them
+        llm_usage = get_llm_client().pop_usage(initial_state["job_id"]).to_dict()
+    debug_log(f"LLM usage for {initial_state['job_id']}: {llm_usage}")
     safe_keyword = sanitize_filename(keyword)
     json_filename = f"{asin}_{safe_keyword}_analysis.json"
     try:
         raw_report = result["final_report"]
         report_data = json.loads(raw_report)
+        report_data["llm_usage"] = llm_usage
+        # Record how many reviews were embedded relative to what was scraped
+        product_index_path, competitor_index_path = get_index_paths(asin, keyword)
+        report_data["review_sampling"] = {
+            "product": load_sampling_stats(product_index_path),
+            "competitors": load_sampling_stats(competitor_index_path),
+        }
         with open(json_filename, "w") as f:
             json.dump(report_data, f, indent=2)
         if output_json:
             print("===BEGIN_JSON===")
             print(json.dumps(report_data))
             print("===END_JSON===")
-            return
+            return True
         print(f"\n==== PRODUCT ANALYSIS SUMMARY FOR {asin} ====\n")
         print("PRODUCT SUMMARY:")
         print(f"Description: {report_data['product_summary']['description']}")
@@ -447,8 +555,10 @@ def main(asin: str, keyword: str, output_json=True, force_rebuild=False):
         for i, change in enumerate(report_data["key_changes_for_sales"], 1):
             print(f"{i}. {change}")
         print(f"\nFull JSON report saved to {json_filename}")
+        return True
     except Exception as e:
         print(f"Error saving or displaying report: {e}", file=sys.stderr)
+        return False
 
 
 if __name__ == "__main__":
@@ -463,27 +573,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "--force-rebuild",
         action="store_true",
-        help="Force delete and rebuild vectorstores from MongoDB",
+        help="Rebuild vectorstores older than INDEX_MAX_AGE_HOURS (default 24) "
+        "or that fail to load",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.getenv("ANALYSIS_METRICS_FILE"),
+        help="Add this run's metrics to this Prometheus text file (totals across runs)",
     )
     args = parser.parse_args()
-    if len(sys.argv) == 1:
-        print("====== Amazon Product Analysis Tool ======")
-        print(
-            "This tool will analyze a product and its competitors based on Amazon data."
-        )
-        asin = input("Enter the product ASIN: ")
-        if not asin:
-            print("Error: ASIN is required.")
-            sys.exit(1)
-        keyword = input("Enter the search keyword for finding competitors: ")
-        if not keyword:
-            print("Error: Search keyword is required.")
-            sys.exit(1)
-        main(asin, keyword, output_json=False, force_rebuild=False)
-    else:
-        main(
-            args.asin,
-            args.keyword,
-            output_json=args.json,
-            force_rebuild=args.force_rebuild,
-        )
+    try:
+        if len(sys.argv) == 1:
+            print("====== Amazon Product Analysis Tool ======")
+            print(
+                "This tool will analyze a product and its competitors based on Amazon data."
+            )
+            asin = input("Enter the product ASIN: ")
+            if not asin:
+                print("Error: ASIN is required.")
+                sys.exit(1)
+            keyword = input("Enter the search keyword for finding competitors: ")
+            if not keyword:
+                print("Error: Search keyword is required.")
+                sys.exit(1)
+            main(asin, keyword, output_json=False, force_rebuild=False)
+        else:
+            main(
+                args.asin,
+                args.keyword,
+                output_json=args.json,
+                force_rebuild=args.force_rebuild,
+            )
+    finally:
+        # Also export metrics for failed jobs (e.g. LLM errors left after retries)
+        dump_metrics(args.metrics_file)
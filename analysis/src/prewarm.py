@@ -0,0 +1,254 @@
+"""Pre-warm FAISS vectorstores for frequently requested keywords and ASINs.
+
+Meant to be run off-peak (e.g. from cron) so that popular analyses find their
+`{asin}_faiss` and `{keyword}_{asin}_faiss` indexes already built:
+    python src/prewarm.py --top 20 --workers 2 --start-deadline 1800 --window 1-6
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import MongoClient
+
+from utils.metrics import MONGO_QUERIES, dump_metrics, start_metrics_server
+from utils.embedding_generator import (
+    connect_to_mongodb,
+    get_competitor_data,
+    get_data_dir,
+    get_index_max_age_hours,
+    get_index_paths,
+    get_product_data,
+    refresh_index,
+    sanitize_filename,
+)
+
+def debug_log(message: str):
+    print(f"[PREWARM] {message}", file=sys.stderr)
+
+
+def get_analysis_history_pairs() -> List[Tuple[str, str]]:
+    """Return (asin, keyword) pairs from the server's Analysis history."""
+    mongo_uri = os.getenv("MONGO_URI", "mongodb://localhost:27017/amazon-analyzer")
+    client = MongoClient(mongo_uri)
+    try:
+        db = client.get_default_database()
+        MONGO_QUERIES.inc(collection="analyses")
+        return [
+            (doc["asin"], doc["keyword"])
+            for doc in db.analyses.find({}, {"asin": 1, "keyword": 1, "_id": 0})
+            if doc.get("asin") and doc.get("keyword")
+        ]
+    except Exception as e:
+        debug_log(f"Could not read analysis history: {e}")
+        return []
+    finally:
+        client.close()
+
+
+def get_search_result_pairs() -> List[Tuple[str, str]]:
+    """Return (asin, keyword) pairs for every scraped search in `search_results`."""
+    client = connect_to_mongodb()
+    try:
+        db = client["adbms_schema"]
+        MONGO_QUERIES.inc(collection="search_results")
+        return [
+            (doc["excluded_asin"], doc["keyword"])
+            for doc in db.search_results.find(
+                {}, {"excluded_asin": 1, "keyword": 1, "_id": 0}
+            )
+            if doc.get("excluded_asin") and doc.get("keyword")
+        ]
+    except Exception as e:
+        debug_log(f"Could not read search results: {e}")
+        return []
+    finally:
+        client.close()
+
+
+def rank_targets(
+    history_pairs: List[Tuple[str, str]],
+    search_pairs: List[Tuple[str, str]],
+    top: int,
+) -> List[Tuple[str, str]]:
+    """Rank (asin, keyword) pairs by how often their keyword and pair are requested.
+
+    Only pairs that have scraped search results are returned, since competitor
+    indexes cannot be built without them. Competitor indexes are per pair, so a
+    popular keyword can be selected with several of its ASINs.
+    """
+    # Keyword matching follows the index naming, so "gym strap" and "gym_strap" share a count
+    keyword_counts = Counter(sanitize_filename(k) for _, k in history_pairs)
+    keyword_counts.update(sanitize_filename(k) for _, k in search_pairs)
+    pair_counts = Counter((a, sanitize_filename(k)) for a, k in history_pairs)
+    pair_counts.update((a, sanitize_filename(k)) for a, k in search_pairs)
+
+    available = set(search_pairs)
+    ranked = sorted(
+        available,
+        key=lambda pair: (
+            keyword_counts[sanitize_filename(pair[1])],
+            pair_counts[(pair[0], sanitize_filename(pair[1]))],
+        ),
+        reverse=True,
+    )
+    return ranked[:top]
+
+
+def prewarm_pair(asin: str, keyword: str, max_age_hours: float) -> Dict:
+    """Build or refresh the product and competitor vectorstores for one pair."""
+    os.makedirs(get_data_dir(), exist_ok=True)
+    product_index_path, competitor_index_path = get_index_paths(asin, keyword)
+    return {
+        "asin": asin,
+        "keyword": keyword,
+        "product": refresh_index(
+            product_index_path, max_age_hours, lambda: get_product_data(asin)
+        ),
+        "competitor": refresh_index(
+            competitor_index_path,
+            max_age_hours,
+            lambda: get_competitor_data(keyword, asin),
+        ),
+    }
+
+
+def parse_window(value: str) -> Tuple[int, int]:
+    """Parse a "START-END" hour window for argparse, e.g. "1-6" or "22-4"."""
+    try:
+        start, end = (int(h) for h in value.split("-"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'invalid window "{value}", expected START-END hours such as "1-6"'
+        )
+    if not (0 <= start <= 23 and 0 <= end <= 23):
+        raise argparse.ArgumentTypeError(
+            f'invalid window "{value}", hours must be between 0 and 23'
+        )
+    return start, end
+
+
+def in_window(
+    window: Optional[Tuple[int, int]], now: Optional[datetime] = None
+) -> bool:
+    """Check whether the current hour falls in a (start, end) hour window (may wrap midnight)."""
+    if not window:
+        return True
+    start, end = window
+    hour = (now or datetime.now()).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def run_prewarm(
+    top: int = 20,
+    workers: int = 2,
+    start_deadline: float = 1800,
+    max_age_hours: float = 24,
+) -> List[Dict]:
+    """Pre-warm the most requested indexes.
+
+    No new builds are started once `start_deadline` seconds have passed; builds
+    already running are allowed to finish, so the run can end later than that.
+    """
+    started_at = time.monotonic()
+    deadline = started_at + start_deadline if start_deadline > 0 else None
+
+    targets = rank_targets(get_analysis_history_pairs(), get_search_result_pairs(), top)
+    debug_log(f"Selected {len(targets)} keyword/ASIN pairs to pre-warm")
+
+    results = []
+    pending_targets = list(targets)
+    running = set()
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        while pending_targets or running:
+            # Only start new work before the start deadline
+            while (
+                pending_targets
+                and len(running) < workers
+                and (deadline is None or time.monotonic() < deadline)
+            ):
+                asin, keyword = pending_targets.pop(0)
+                debug_log(f"Pre-warming ASIN {asin} / keyword '{keyword}'")
+                running.add(executor.submit(prewarm_pair, asin, keyword, max_age_hours))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                    debug_log(f"Finished {result}")
+                    results.append(result)
+                except Exception as e:
+                    debug_log(f"Pre-warm job failed: {e}")
+    finally:
+        executor.shutdown(wait=True)
+
+    if pending_targets:
+        debug_log(f"Start deadline passed, skipped {len(pending_targets)} pairs")
+    debug_log(f"Pre-warm completed in {time.monotonic() - started_at:.1f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pre-warm vectorstores for popular keywords and ASINs"
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="Number of keyword/ASIN pairs to pre-warm"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=2, help="Number of indexes built concurrently"
+    )
+    parser.add_argument(
+        "--start-deadline",
+        type=float,
+        default=1800,
+        help="Don't start new builds after this many seconds (0 = no limit); "
+        "builds already running still finish, so leave headroom before the window ends",
+    )
+    parser.add_argument(
+        "--max-age-hours",
+        type=float,
+        default=get_index_max_age_hours(),
+        help="Rebuild indexes older than this (0 = only build missing indexes); "
+        "defaults to INDEX_MAX_AGE_HOURS, matching RAG.py --force-rebuild",
+    )
+    parser.add_argument(
+        "--window",
+        type=parse_window,
+        help='Only run during this local hour window, e.g. "1-6" or "22-4"',
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="Serve Prometheus metrics on this port"
+    )
+    parser.add_argument(
+        "--metrics-file",
+        default=os.getenv("ANALYSIS_METRICS_FILE"),
+        help="Add this run's metrics to this Prometheus text file (totals across runs)",
+    )
+    args = parser.parse_args()
+
+    if not in_window(args.window):
+        debug_log(f"Outside of pre-warm window {args.window[0]}-{args.window[1]}, exiting")
+        sys.exit(0)
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    try:
+        run_prewarm(
+            top=args.top,
+            workers=args.workers,
+            start_deadline=args.start_deadline,
+            max_age_hours=args.max_age_hours,
+        )
+    finally:
+        dump_metrics(args.metrics_file)
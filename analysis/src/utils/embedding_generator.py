@@ -1,18 +1,38 @@
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
+import glob
 import json
 import os
 import re
+import shutil
 import subprocess
 import time
+import uuid
 from pymongo import MongoClient
 from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from utils.file_lock import FileLock
+from utils.hybrid_retriever import save_bm25_index
+from utils.review_sampler import get_sampling_config, sample_reviews
+from utils.metrics import (
+    EMBEDDINGS_COMPUTED,
+    MONGO_QUERIES,
+    STAGE_LATENCY,
+    VECTORSTORE_CACHE,
+)
 from bson import ObjectId
 from datetime import datetime
 
 # Initialize the embedding model
 embedding_model = HuggingFaceEmbeddings(model_name="BAAI/bge-small-en-v1.5")
 
+SAMPLING_FILENAME = "sampling.json"
+
+# Indexes older than this are rebuilt by --force-rebuild and prewarm.py
+DEFAULT_INDEX_MAX_AGE_HOURS = 24.0
+
+# Builds can take minutes; a build lock older than this was left by a crashed process
+INDEX_LOCK_STALE_AFTER = 3600.0
+
 
 class MongoJSONEncoder(json.JSONEncoder):
     """Custom JSON encoder that handles MongoDB ObjectId and datetime objects."""
@@ -36,19 +56,65 @@ def sanitize_filename(name: str) -> str:
     return re.sub(r"[^a-zA-Z0-9_]", "_", name)
 
 
-def check_vectorstore_exists(asin: str, keyword: str) -> Tuple[bool, bool]:
-    """Check if vectorstores for the given ASIN and keyword already exist."""
+def get_data_dir() -> str:
+    """Return the directory where FAISS vectorstores are stored."""
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(current_dir, "../.."))
-    data_dir = os.path.join(project_root, "data")
+    return os.path.join(project_root, "data")
 
+
+def get_index_paths(asin: str, keyword: str) -> Tuple[str, str]:
+    """Return the product and competitor vectorstore paths for an analysis.
+    Competitors are found per keyword excluding the analyzed product, so the
+    competitor index is keyed by both."""
+    data_dir = get_data_dir()
     safe_keyword = sanitize_filename(keyword)
+    return (
+        os.path.join(data_dir, f"{asin}_faiss"),
+        os.path.join(data_dir, f"{safe_keyword}_{asin}_faiss"),
+    )
 
-    product_faiss_path = os.path.join(data_dir, f"{asin}_faiss")
-    competitor_faiss_path = os.path.join(data_dir, f"{safe_keyword}_faiss")
 
-    product_exists = os.path.exists(product_faiss_path)
-    competitor_exists = os.path.exists(competitor_faiss_path)
+def get_index_max_age_hours() -> float:
+    """Return the index max age from INDEX_MAX_AGE_HOURS (0 = never stale)."""
+    try:
+        return float(os.getenv("INDEX_MAX_AGE_HOURS", DEFAULT_INDEX_MAX_AGE_HOURS))
+    except ValueError:
+        return DEFAULT_INDEX_MAX_AGE_HOURS
+
+
+def is_index_stale(index_path: str, max_age_hours: float) -> bool:
+    """Return True if the index is missing or older than max_age_hours."""
+    if not index_exists(index_path):
+        return True
+    if max_age_hours <= 0:
+        return False
+    age_hours = (time.time() - os.path.getmtime(index_path)) / 3600
+    return age_hours > max_age_hours
+
+
+def index_exists(index_path: str, timeout: float = 2.0) -> bool:
+    """Check whether an index exists, waiting out an in-progress swap.
+
+    build_index_atomically replaces an index by moving the live one to
+    `{path}.old.*` and moving the new build into place; between the two
+    renames the path is briefly missing."""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(index_path):
+        if not glob.glob(f"{glob.escape(index_path)}.old.*") or (
+            time.monotonic() > deadline
+        ):
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def check_vectorstore_exists(asin: str, keyword: str) -> Tuple[bool, bool]:
+    """Check if vectorstores for the given ASIN and keyword already exist."""
+    product_faiss_path, competitor_faiss_path = get_index_paths(asin, keyword)
+
+    product_exists = index_exists(product_faiss_path)
+    competitor_exists = index_exists(competitor_faiss_path)
 
     return product_exists, competitor_exists
 
@@ -87,7 +153,8 @@ def trigger_scraper(asin: str, keyword: str) -> bool:
 
 
 def get_product_data(asin: str) -> Dict:
-    """Fetch product data from MongoDB using ASIN."""
+    """Fetch product data from MongoDB using ASIN.
+    Reviews are capped per ASIN by stratified sampling (see utils/review_sampler.py)."""
     client = connect_to_mongodb()
     db = client["adbms_schema"]
 
@@ -96,25 +163,31 @@ def get_product_data(asin: str) -> Dict:
 
     # Fetch product description
     product_desc = db.descriptions.find_one({"asin": asin})
+    MONGO_QUERIES.inc(collection="descriptions")
     if product_desc:
         product_data["description"] = product_desc
 
-    # Fetch ALL product reviews (no limit)
+    # Fetch all product reviews, then sample them down to the configured cap
     positive_reviews = list(db.reviews.find({"asin": asin, "review_type": "positive"}))
     critical_reviews = list(db.reviews.find({"asin": asin, "review_type": "critical"}))
+    MONGO_QUERIES.inc(2, collection="reviews")
 
     if positive_reviews or critical_reviews:
-        product_data["reviews"] = {
-            "positive": positive_reviews,
-            "critical": critical_reviews,
-        }
+        max_reviews, seed = get_sampling_config()
+        product_data["reviews"], product_data["sampling"] = sample_reviews(
+            {"positive": positive_reviews, "critical": critical_reviews},
+            max_reviews,
+            seed,
+            asin,
+        )
 
     client.close()
     return product_data
 
 
 def get_competitor_data(keyword: str, main_asin: str) -> Dict:
-    """Fetch competitor data from MongoDB using keyword."""
+    """Fetch competitor data from MongoDB using keyword.
+    Reviews are capped per competitor ASIN by stratified sampling."""
     client = connect_to_mongodb()
     db = client["adbms_schema"]
 
@@ -122,8 +195,10 @@ def get_competitor_data(keyword: str, main_asin: str) -> Dict:
     search_results = db.search_results.find_one(
         {"keyword": keyword, "excluded_asin": main_asin}
     )
+    MONGO_QUERIES.inc(collection="search_results")
 
     competitors_data = {}
+    max_reviews, seed = get_sampling_config()
 
     if search_results and "competitor_asins" in search_results:
         # Get competitor ASINs (still limit to top 5 competitors)
@@ -134,22 +209,28 @@ def get_competitor_data(keyword: str, main_asin: str) -> Dict:
 
             # Fetch competitor description
             desc = db.descriptions.find_one({"asin": competitor_asin})
+            MONGO_QUERIES.inc(collection="descriptions")
             if desc:
                 competitor_info["description"] = desc
 
-            # Fetch ALL competitor reviews (no limit)
+            # Fetch all competitor reviews, then sample them down to the configured cap
             positive_reviews = list(
                 db.reviews.find({"asin": competitor_asin, "review_type": "positive"})
             )
             critical_reviews = list(
                 db.reviews.find({"asin": competitor_asin, "review_type": "critical"})
             )
+            MONGO_QUERIES.inc(2, collection="reviews")
 
             if positive_reviews or critical_reviews:
-                competitor_info["reviews"] = {
-                    "positive": positive_reviews,
-                    "critical": critical_reviews,
-                }
+                competitor_info["reviews"], competitor_info["sampling"] = (
+                    sample_reviews(
+                        {"positive": positive_reviews, "critical": critical_reviews},
+                        max_reviews,
+                        seed,
+                        competitor_asin,
+                    )
+                )
 
             if competitor_info:
                 competitors_data[competitor_asin] = competitor_info
@@ -158,32 +239,218 @@ def get_competitor_data(keyword: str, main_asin: str) -> Dict:
     return competitors_data
 
 
-def create_faiss_from_data(data: Dict, output_path: str) -> None:
-    """Create a FAISS vectorstore directly from data dictionary."""
+DESCRIPTION_SKIP_FIELDS = {"_id", "asin", "timestamp", "createdAt", "updatedAt"}
+
+
+def _product_documents(
+    asin: str, info: Dict, role: str
+) -> Tuple[List[str], List[Dict]]:
+    """Split one product's description and reviews into separate documents."""
+    label = "Product" if role == "product" else "Competitor"
+    texts = []
+    metadatas = []
+
+    description = info.get("description")
+    if description:
+        lines = [f"{label} {asin} description"]
+        for key, value in description.items():
+            if key not in DESCRIPTION_SKIP_FIELDS and value not in (None, ""):
+                lines.append(f"{key}: {value}")
+        texts.append("\n".join(lines))
+        metadatas.append({"asin": asin, "role": role, "source": "description"})
+
+    for review_type, reviews in info.get("reviews", {}).items():
+        for review in reviews:
+            details = [
+                f"{review.get('rating')} stars" if review.get("rating") else None,
+                f"{review.get('helpful_votes')} helpful votes"
+                if review.get("helpful_votes")
+                else None,
+                review.get("date"),
+            ]
+            header = f"{label} {asin} {review_type} review"
+            details_text = ", ".join(d for d in details if d)
+            if details_text:
+                header += f" ({details_text})"
+            title = review.get("title") or ""
+            body = review.get("body") or ""
+            texts.append(f"{header}: {title}. {body}".strip())
+            metadatas.append(
+                {
+                    "asin": asin,
+                    "role": role,
+                    "source": "review",
+                    "review_type": review_type,
+                    "rating": review.get("rating"),
+                }
+            )
+
+    return texts, metadatas
+
+
+def data_to_documents(data: Dict) -> Tuple[List[str], List[Dict]]:
+    """Convert product data (from get_product_data) or competitor data
+    (from get_competitor_data) into per-description and per-review documents."""
+    texts = []
+    metadatas = []
+    if is_product_data(data):
+        description = data.get("description") or {}
+        asin = description.get("asin")
+        if not asin:
+            for reviews in data.get("reviews", {}).values():
+                if reviews:
+                    asin = reviews[0].get("asin")
+                    break
+        return _product_documents(asin or "unknown", data, "product")
+
+    for competitor_asin, competitor_info in data.items():
+        comp_texts, comp_metadatas = _product_documents(
+            competitor_asin, competitor_info, "competitor"
+        )
+        texts.extend(comp_texts)
+        metadatas.extend(comp_metadatas)
+    return texts, metadatas
+
+
+def is_product_data(data: Dict) -> bool:
+    """True for get_product_data output, False for get_competitor_data output."""
+    return "description" in data or "reviews" in data
+
+
+def extract_sampling_stats(data: Dict) -> Dict:
+    """Collect the review sampling stats recorded by get_product_data/get_competitor_data."""
+    if is_product_data(data):
+        return data.get("sampling", {})
+    return {
+        competitor_asin: competitor_info["sampling"]
+        for competitor_asin, competitor_info in data.items()
+        if "sampling" in competitor_info
+    }
+
+
+def load_sampling_stats(index_path: str) -> Dict:
+    """Read the sampling stats saved next to a vectorstore (empty if none)."""
+    path = os.path.join(index_path, SAMPLING_FILENAME)
+    if not os.path.exists(path):
+        return {}
     try:
-        # Convert the entire data to a string for embedding
-        full_text = json.dumps(data, cls=MongoJSONEncoder)
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading sampling stats from {path}: {str(e)}")
+        return {}
+
 
-        # For metadata, create a copy with ObjectIds converted to strings
-        serializable_metadata = json.loads(full_text)
+def create_faiss_from_data(data: Dict, output_path: str) -> bool:
+    """Create a FAISS vectorstore directly from data dictionary.
+    Returns True if the vectorstore was saved."""
+    try:
+        # One document per description and per review, so retrieval can select
+        # the relevant parts instead of returning everything at once
+        texts, metadatas = data_to_documents(data)
+        if not texts:
+            print(f"No documents to embed for {output_path}")
+            return False
+
+        # Round-trip metadata through JSON to convert ObjectIds and datetimes
+        metadatas = json.loads(json.dumps(metadatas, cls=MongoJSONEncoder))
 
-        # Create FAISS vectorstore directly with the full content
         vectorstore = FAISS.from_texts(
-            texts=[full_text],
+            texts=texts,
             embedding=embedding_model,
-            metadatas=[serializable_metadata],  # Store the entire data as metadata
+            metadatas=metadatas,
+        )
+        EMBEDDINGS_COMPUTED.inc(
+            len(texts),
+            index_type="product" if is_product_data(data) else "competitor",
         )
 
-        # Save the FAISS index to disk
+        # Save the FAISS index and its BM25 sidecar to disk
         vectorstore.save_local(output_path)
-        print(f"FAISS vectorstore saved to {output_path}")
+        save_bm25_index(vectorstore, output_path)
+        with open(
+            os.path.join(output_path, SAMPLING_FILENAME), "w", encoding="utf-8"
+        ) as f:
+            json.dump(extract_sampling_stats(data), f, indent=2)
+        print(f"FAISS vectorstore saved to {output_path} ({len(texts)} documents)")
+        return True
 
     except Exception as e:
         print(f"Error creating FAISS vectorstore: {str(e)}")
+        return False
+
+
+def index_lock(index_path: str) -> FileLock:
+    """Cross-process lock serializing builds and removals of one index."""
+    return FileLock(
+        f"{index_path}.lock", stale_after=INDEX_LOCK_STALE_AFTER, poll_interval=0.5
+    )
 
 
-def generate_embeddings(asin: str, keyword: str):
-    """Generate embeddings for product and competitor data."""
+def build_index_atomically(data: Dict, index_path: str) -> bool:
+    """Build a vectorstore next to the live one and swap it in when complete,
+    so running analyses never load a half-written index.
+
+    Directories can't be replaced in a single rename, so the live index is
+    moved to `{path}.old.*` first; readers wait out that short gap (see
+    index_exists). Callers must hold index_lock(index_path)."""
+    suffix = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    tmp_path = f"{index_path}.build.{suffix}"
+    old_path = f"{index_path}.old.{suffix}"
+    try:
+        if not create_faiss_from_data(data, tmp_path):
+            return False
+        if os.path.exists(index_path):
+            os.rename(index_path, old_path)
+        os.rename(tmp_path, index_path)
+        return True
+    finally:
+        for path in (tmp_path, old_path):
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+
+def refresh_index(index_path: str, max_age_hours: float, load_data) -> str:
+    """Rebuild one index if it is missing or stale; returns "warm", "built" or "failed".
+
+    Used by analyses and prewarm.py alike, so an index is built once even when
+    several processes need it at the same time."""
+    with index_lock(index_path):
+        # Re-check under the lock: another process may have just built it
+        if not is_index_stale(index_path, max_age_hours):
+            return "warm"
+        data = load_data()
+        if data and build_index_atomically(data, index_path):
+            return "built"
+        return "failed"
+
+
+def discard_index(index_path: str, loaded_mtime: Optional[float]):
+    """Remove an index that failed to load so the next refresh rebuilds it.
+
+    Skipped if the index was replaced since `loaded_mtime`, i.e. another
+    process already rebuilt it."""
+    old_path = f"{index_path}.old.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    with index_lock(index_path):
+        try:
+            if os.path.getmtime(index_path) != loaded_mtime:
+                return
+            # Rename first so readers never see a partly deleted index
+            os.rename(index_path, old_path)
+        except OSError:
+            return
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def generate_embeddings(asin: str, keyword: str, max_age_hours: float = 0):
+    """Generate embeddings for product and competitor data.
+    Missing indexes are built; existing ones are rebuilt if older than
+    max_age_hours (0 = never)."""
+    with STAGE_LATENCY.time(stage="generate_embeddings"):
+        return _generate_embeddings(asin, keyword, max_age_hours)
+
+
+def _generate_embeddings(asin: str, keyword: str, max_age_hours: float):
     # Get the absolute path to the project root
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(current_dir, "../.."))
@@ -192,17 +459,20 @@ def generate_embeddings(asin: str, keyword: str):
     data_dir = os.path.join(project_root, "data")
     os.makedirs(data_dir, exist_ok=True)
 
-    # Sanitize keyword for safe filename
-    safe_keyword = sanitize_filename(keyword)
-
     # Define output paths with improved naming convention
-    product_faiss_path = os.path.join(data_dir, f"{asin}_faiss")
-    competitor_faiss_path = os.path.join(data_dir, f"{safe_keyword}_faiss")
+    product_faiss_path, competitor_faiss_path = get_index_paths(asin, keyword)
 
-    # STEP 1: Check if vectorstores already exist
-    product_vs_exists, competitor_vs_exists = check_vectorstore_exists(asin, keyword)
+    # STEP 1: Check if vectorstores already exist (and are recent enough)
+    product_vs_stale = is_index_stale(product_faiss_path, max_age_hours)
+    competitor_vs_stale = is_index_stale(competitor_faiss_path, max_age_hours)
+    VECTORSTORE_CACHE.inc(
+        index_type="product", result="miss" if product_vs_stale else "hit"
+    )
+    VECTORSTORE_CACHE.inc(
+        index_type="competitor", result="miss" if competitor_vs_stale else "hit"
+    )
 
-    if product_vs_exists and competitor_vs_exists:
+    if not product_vs_stale and not competitor_vs_stale:
         print(f"Vectorstores already exist for ASIN {asin} and keyword '{keyword}'")
         return True
 
@@ -222,54 +492,33 @@ def generate_embeddings(asin: str, keyword: str):
     print("Starting vectorstore generation")
     print(f"Fetching data for ASIN {asin} and keyword '{keyword}'")
 
-    # Create product vectorstore if needed
-    if not product_vs_exists:
-        # Get product data from MongoDB including ALL reviews
-        product_data = get_product_data(asin)
-        if product_data:
-            # Create vectorstore for product
-            create_faiss_from_data(product_data, product_faiss_path)
-
-            # Report statistics
-            review_count = 0
-            if "reviews" in product_data:
-                if "positive" in product_data["reviews"]:
-                    review_count += len(product_data["reviews"]["positive"])
-                if "critical" in product_data["reviews"]:
-                    review_count += len(product_data["reviews"]["critical"])
-            print(f"Embedded product with {review_count} reviews into {asin}_faiss")
-        else:
-            print(f"No data found for product with ASIN {asin}")
+    # Indexes are built under a cross-process lock and swapped in atomically,
+    # so concurrent analyses and prewarm.py never build or read them half-way
+    if product_vs_stale:
+        # Product reviews are sampled to the configured cap
+        status = refresh_index(
+            product_faiss_path, max_age_hours, lambda: get_product_data(asin)
+        )
+        if status == "failed":
+            print(f"Failed to create product vectorstore for ASIN {asin}")
             return False
-
-    # Create competitor vectorstore if needed
-    if not competitor_vs_exists:
-        # Get competitor data from MongoDB including ALL reviews
-        competitor_data = get_competitor_data(keyword, asin)
-        if competitor_data:
-            # Create vectorstore for competitors
-            create_faiss_from_data(competitor_data, competitor_faiss_path)
-
-            # Report statistics
-            competitor_count = len(competitor_data)
-            total_review_count = 0
-            for comp_asin, comp_info in competitor_data.items():
-                if "reviews" in comp_info:
-                    if "positive" in comp_info["reviews"]:
-                        total_review_count += len(comp_info["reviews"]["positive"])
-                    if "critical" in comp_info["reviews"]:
-                        total_review_count += len(comp_info["reviews"]["critical"])
-            print(
-                f"Embedded {competitor_count} competitors with a total of {total_review_count} reviews into {safe_keyword}_faiss"
-            )
-        else:
-            print(f"No competitor data found for keyword '{keyword}'")
+        print(f"Product vectorstore for ASIN {asin}: {status}")
+
+    if competitor_vs_stale:
+        # Competitor reviews are sampled to the configured cap
+        status = refresh_index(
+            competitor_faiss_path,
+            max_age_hours,
+            lambda: get_competitor_data(keyword, asin),
+        )
+        if status == "failed":
+            print(f"Failed to create competitor vectorstore for keyword '{keyword}'")
             return False
+        print(f"Competitor vectorstore for keyword '{keyword}': {status}")
 
     print("Completed vectorstore generation")
     return True
 
-
 if __name__ == "__main__":
     # Example usage - in production, these would come from API/user input
     sample_asin = "B07ZPML7NP"  # Example ASIN
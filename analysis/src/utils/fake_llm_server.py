@@ -0,0 +1,130 @@
+"""Local fake LLM server for exercising the analysis pipeline without Gemini quota.
+
+Run it and point the analysis at it:
+    python src/utils/fake_llm_server.py --port 8765 --rpm 30 --error-rate 0.1
+    LLM_FAKE_URL=http://localhost:8765/generate python src/RAG.py --asin ... --keyword ...
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FAKE_REPORT = {
+    "product_summary": {
+        "description": "Fake product description",
+        "main_problems": "Fake summary of main problems",
+    },
+    "main_product": {
+        "asin": "FAKE",
+        "pros": ["Fake pro 1", "Fake pro 2", "Fake pro 3"],
+        "cons": ["Fake con 1", "Fake con 2", "Fake con 3"],
+    },
+    "competitors": [
+        {
+            "identifier": "Competitor 1",
+            "pros": ["Fake pro 1", "Fake pro 2"],
+            "cons": ["Fake con 1", "Fake con 2"],
+        }
+    ],
+    "key_changes_for_sales": ["Fake change 1", "Fake change 2"],
+    "complete_report": {
+        "product_analysis": "Fake product analysis",
+        "competitor_analysis": "Fake competitor analysis",
+        "recommendations": "Fake recommendations",
+    },
+}
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+    rpm = 0
+    request_times = deque()
+    lock = threading.Lock()
+
+    def _over_quota(self) -> bool:
+        if not self.rpm:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.request_times and now - self.request_times[0] > 60:
+                self.request_times.popleft()
+            if len(self.request_times) >= self.rpm:
+                return True
+            self.request_times.append(now)
+        return False
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        prompt = request.get("prompt", "")
+
+        if self._over_quota():
+            self._send_json(429, {"error": "Quota exceeded"})
+            return
+        if random.random() < self.error_rate:
+            self._send_json(503, {"error": "Simulated upstream failure"})
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        if "valid JSON" in prompt:
+            text = json.dumps(FAKE_REPORT, indent=2)
+        else:
+            text = f"Fake analysis generated for a prompt of {len(prompt)} characters."
+        self._send_json(
+            200,
+            {
+                "text": text,
+                "usage": {
+                    "input_tokens": max(1, len(prompt) // 4),
+                    "output_tokens": max(1, len(text) // 4),
+                },
+            },
+        )
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run_server(port: int, latency: float, error_rate: float, rpm: int):
+    FakeLLMHandler.latency = latency
+    FakeLLMHandler.error_rate = error_rate
+    FakeLLMHandler.rpm = rpm
+    server = ThreadingHTTPServer(("localhost", port), FakeLLMHandler)
+    print(f"Fake LLM server listening on http://localhost:{port}/generate")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake LLM server for testing")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds to wait per response"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Fraction of 503 responses"
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=0, help="Requests per minute before 429 (0 = off)"
+    )
+    args = parser.parse_args()
+    run_server(args.port, args.latency, args.error_rate, args.rpm)
@@ -0,0 +1,99 @@
+"""Portable inter-process lock based on exclusive lock-file creation.
+
+The analysis server starts a separate Python process per request, so state
+shared between analyses (LLM rate limits, metrics files, index builds) has to
+be coordinated through the filesystem. Works on Linux, macOS and Windows.
+"""
+
+import os
+import time
+import uuid
+
+
+class FileLock:
+    """Lock held by creating `path` exclusively; stale locks are broken after `stale_after` seconds.
+
+    The lock file holds a per-holder token, so a holder whose lock was broken
+    as stale never removes the lock of whoever acquired it next.
+    """
+
+    def __init__(self, path: str, stale_after: float = 30.0, poll_interval: float = 0.01):
+        self.path = path
+        self.stale_after = stale_after
+        self.poll_interval = poll_interval
+        self.token = f"{os.getpid()}:{uuid.uuid4().hex}"
+        self.held = False
+
+    def try_acquire(self) -> bool:
+        """Acquire the lock without waiting; returns False if another holder has it."""
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            self._break_if_stale()
+            return False
+        # Closed right away so other processes can rename it on Windows too
+        try:
+            os.write(fd, self.token.encode("utf-8"))
+        finally:
+            os.close(fd)
+        self.held = True
+        return True
+
+    def _break_if_stale(self):
+        """Remove the lock file if its holder has kept it longer than stale_after.
+
+        The stale file is claimed by renaming it to a unique name, so when
+        several waiters see the same stale lock only one of them removes it.
+        """
+        try:
+            stat = os.stat(self.path)
+            if time.time() - stat.st_mtime <= self.stale_after:
+                return
+            claimed_path = f"{self.path}.stale.{uuid.uuid4().hex}"
+            os.rename(self.path, claimed_path)
+        except OSError:
+            # Released, or already broken by another waiter
+            return
+        claimed = os.stat(claimed_path)
+        if (claimed.st_ino, claimed.st_mtime) != (stat.st_ino, stat.st_mtime):
+            # Another waiter broke the stale lock and re-acquired it between our
+            # stat and rename: put the fresh lock back unless the path was taken again
+            try:
+                os.link(claimed_path, self.path)
+            except OSError:
+                pass
+        try:
+            os.remove(claimed_path)
+        except OSError:
+            pass
+
+    def _holds_lock(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return f.read() == self.token
+        except OSError:
+            return False
+
+    def acquire(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        while not self.try_acquire():
+            time.sleep(self.poll_interval)
+
+    def release(self):
+        if self.held:
+            self.held = False
+            # If our lock was broken as stale, the file now belongs to someone else
+            if self._holds_lock():
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,203 @@
+"""Hybrid lexical + dense retrieval over the FAISS vectorstores.
+
+Each vectorstore directory gets a BM25 sidecar (`bm25.json`) next to
+`index.faiss`. Retrieval issues several aspect queries at once: the queries are
+embedded in a single batch (with an on-disk cache), searched against FAISS in
+one batched call, scored with BM25, and all ranked lists are fused with
+reciprocal rank fusion.
+"""
+
+import json
+import math
+import os
+import re
+import sys
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from utils.metrics import QUERY_EMBEDDING_CACHE
+
+
+BM25_FILENAME = "bm25.json"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Minimal Okapi BM25 index keyed by FAISS docstore ids."""
+
+    def __init__(
+        self,
+        doc_ids: List[str],
+        term_freqs: List[Dict[str, int]],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.k1 = k1
+        self.b = b
+        self.doc_lens = [sum(tf.values()) for tf in term_freqs]
+        self.avgdl = (sum(self.doc_lens) / len(self.doc_lens)) if self.doc_lens else 0
+        self.df = Counter()
+        for tf in term_freqs:
+            self.df.update(tf.keys())
+
+    @classmethod
+    def from_texts(cls, doc_ids: List[str], texts: List[str]) -> "BM25Index":
+        return cls(doc_ids, [dict(Counter(tokenize(text))) for text in texts])
+
+    @classmethod
+    def from_vectorstore(cls, vectorstore) -> "BM25Index":
+        """Build the index from the documents already stored in a FAISS vectorstore."""
+        doc_ids = [
+            vectorstore.index_to_docstore_id[i]
+            for i in range(len(vectorstore.index_to_docstore_id))
+        ]
+        texts = [vectorstore.docstore.search(doc_id).page_content for doc_id in doc_ids]
+        return cls.from_texts(doc_ids, texts)
+
+    def save(self, index_path: str):
+        with open(os.path.join(index_path, BM25_FILENAME), "w", encoding="utf-8") as f:
+            json.dump({"doc_ids": self.doc_ids, "term_freqs": self.term_freqs}, f)
+
+    @classmethod
+    def load(cls, index_path: str) -> Optional["BM25Index"]:
+        path = os.path.join(index_path, BM25_FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["doc_ids"], data["term_freqs"])
+
+    def search(self, query: str, k: int) -> List[str]:
+        """Return the ids of the top-k documents for the query."""
+        n_docs = len(self.doc_ids)
+        if not n_docs:
+            return []
+        scores = [0.0] * n_docs
+        for term in set(tokenize(query)):
+            df = self.df.get(term)
+            if not df:
+                continue
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for i, tf in enumerate(self.term_freqs):
+                freq = tf.get(term)
+                if not freq:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[i] / self.avgdl)
+                scores[i] += idf * freq * (self.k1 + 1) / (freq + norm)
+        ranked = sorted(
+            (i for i in range(n_docs) if scores[i] > 0),
+            key=lambda i: scores[i],
+            reverse=True,
+        )
+        return [self.doc_ids[i] for i in ranked[:k]]
+
+
+class QueryEmbeddingCache:
+    """Query embeddings persisted to disk so fixed aspect queries are embedded once."""
+
+    def __init__(self, cache_path: Optional[str], model_name: str):
+        self.cache_path = cache_path
+        self.model_name = model_name
+        self.entries: Dict[str, Dict[str, List[float]]] = {}
+        if cache_path and os.path.exists(cache_path):
+            try:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"[WARN] Ignoring unreadable query cache: {e}", file=sys.stderr)
+
+    def embed(self, queries: List[str], embedding) -> List[List[float]]:
+        """Return embeddings for the queries, embedding cache misses in one batch."""
+        cached = self.entries.setdefault(self.model_name, {})
+        missing = [q for q in dict.fromkeys(queries) if q not in cached]
+        QUERY_EMBEDDING_CACHE.inc(len(queries) - len(missing), result="hit")
+        QUERY_EMBEDDING_CACHE.inc(len(missing), result="miss")
+        if missing:
+            for query, vector in zip(missing, embedding.embed_documents(missing)):
+                cached[query] = list(vector)
+            self._save()
+        return [cached[q] for q in queries]
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        tmp_path = f"{self.cache_path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.cache_path)
+        except Exception as e:
+            print(f"[WARN] Could not save query cache: {e}", file=sys.stderr)
+
+
+def save_bm25_index(vectorstore, index_path: str):
+    """Write the BM25 sidecar for a freshly saved FAISS vectorstore."""
+    BM25Index.from_vectorstore(vectorstore).save(index_path)
+
+
+class HybridRetriever:
+    """Multi-query retriever fusing FAISS and BM25 rankings with reciprocal rank fusion."""
+
+    def __init__(
+        self,
+        vectorstore,
+        index_path: str,
+        embedding,
+        query_cache: QueryEmbeddingCache,
+        k: int = 8,
+        fetch_k: int = 20,
+        rrf_k: int = 60,
+    ):
+        self.vectorstore = vectorstore
+        self.embedding = embedding
+        self.query_cache = query_cache
+        self.k = k
+        self.fetch_k = fetch_k
+        self.rrf_k = rrf_k
+        self.bm25 = BM25Index.load(index_path)
+        if self.bm25 is None or set(self.bm25.doc_ids) != set(
+            vectorstore.index_to_docstore_id.values()
+        ):
+            # Indexes built before the sidecar existed, or replaced by a rebuild
+            # after the vectorstore was loaded: build it in memory
+            self.bm25 = BM25Index.from_vectorstore(vectorstore)
+
+    def _dense_search(self, queries: List[str]) -> List[List[str]]:
+        vectors = np.array(self.query_cache.embed(queries, self.embedding), dtype=np.float32)
+        if getattr(self.vectorstore, "_normalize_L2", False):
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        fetch_k = min(self.fetch_k, self.vectorstore.index.ntotal)
+        if fetch_k <= 0:
+            return [[] for _ in queries]
+        _, positions = self.vectorstore.index.search(vectors, fetch_k)
+        return [
+            [self.vectorstore.index_to_docstore_id[p] for p in row if p != -1]
+            for row in positions
+        ]
+
+    def invoke(self, queries: List[str]) -> List[Document]:
+        """Retrieve the top-k documents across all queries."""
+        ranked_lists = self._dense_search(queries)
+        ranked_lists += [self.bm25.search(query, self.fetch_k) for query in queries]
+
+        fused: Dict[str, float] = {}
+        for ranked in ranked_lists:
+            for rank, doc_id in enumerate(ranked):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+
+        top_ids = sorted(fused, key=fused.get, reverse=True)[: self.k]
+        return [self.vectorstore.docstore.search(doc_id) for doc_id in top_ids]
+
+
+def format_documents(documents: List[Document]) -> str:
+    """Join retrieved documents into a compact prompt context."""
+    return "\n\n".join(doc.page_content for doc in documents)
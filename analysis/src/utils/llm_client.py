@@ -0,0 +1,362 @@
+"""Shared async LLM client with rate limiting, retries and per-job usage accounting."""
+
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from typing import Dict, Optional
+
+from langchain_core.prompt_values import PromptValue
+
+from utils.file_lock import FileLock
+from utils.metrics import LLM_CALLS, LLM_ERRORS, LLM_LATENCY, LLM_RETRIES, LLM_TOKENS
+
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+# Exception class names (google.api_core / httpx) that indicate a transient failure
+RETRYABLE_ERRORS = {
+    "ResourceExhausted",
+    "TooManyRequests",
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "InternalServerError",
+    "GatewayTimeout",
+    "TimeoutError",
+    "ConnectError",
+    "ReadTimeout",
+}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token) used when the API reports no usage."""
+    return max(1, len(text) // 4)
+
+
+class LLMBudgetExceeded(Exception):
+    """Raised when a job has used up its token budget."""
+
+
+class FileTokenBucket:
+    """Token bucket that refills at a fixed rate per minute.
+
+    The bucket state is kept in a file guarded by a lock file, so every
+    analysis process on the host draws from the same quota.
+    """
+
+    def __init__(self, state_dir: str, rate_per_minute: float, capacity: float):
+        self.state_path = os.path.join(state_dir, "bucket.json")
+        self.lock_path = os.path.join(state_dir, "bucket.lock")
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, capacity)
+
+    def _try_take(self, amount: float) -> float:
+        """Take `amount` tokens if available; returns 0 on success, else seconds to wait."""
+        with FileLock(self.lock_path, stale_after=5):
+            now = time.time()
+            try:
+                with open(self.state_path, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {"tokens": self.capacity, "updated_at": now}
+            tokens = min(
+                self.capacity,
+                state["tokens"] + max(0.0, now - state["updated_at"]) * self.rate,
+            )
+            wait = 0.0
+            if tokens >= amount:
+                tokens -= amount
+            else:
+                wait = (amount - tokens) / self.rate
+            tmp_path = f"{self.state_path}.tmp.{os.getpid()}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"tokens": tokens, "updated_at": now}, f)
+            os.replace(tmp_path, self.state_path)
+        return wait
+
+    async def acquire(self, amount: float = 1.0):
+        """Wait until `amount` tokens are available and take them."""
+        while True:
+            wait = await asyncio.to_thread(self._try_take, amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+
+class FileSemaphore:
+    """Caps in-flight requests across processes using one lock file per slot."""
+
+    def __init__(self, state_dir: str, slots: int, stale_after: float):
+        self.state_dir = state_dir
+        self.slots = max(1, slots)
+        self.stale_after = stale_after
+
+    async def acquire(self) -> FileLock:
+        """Wait for a free slot; release the returned lock when the call is done."""
+        while True:
+            for i in range(self.slots):
+                slot = FileLock(
+                    os.path.join(self.state_dir, f"slot_{i}.lock"),
+                    stale_after=self.stale_after,
+                )
+                if slot.try_acquire():
+                    return slot
+            await asyncio.sleep(0.05)
+
+
+class JobUsage:
+    """Token, cost and call counters for a single analysis job."""
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost_usd = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "retries": self.retries,
+            "errors": self.errors,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": self.total_tokens,
+            "cost_usd": round(self.cost_usd, 6),
+        }
+
+
+class AsyncLLMClient:
+    """Rate-limited async wrapper around the Gemini chat model.
+
+    Calls go through a token bucket (requests per minute), a concurrency cap,
+    a per-call timeout and exponential backoff with jitter. The bucket and the
+    concurrency slots live in `state_dir` (LLM_RATE_LIMIT_DIR), so all analysis
+    processes on the same host share one quota. Processes on different hosts
+    are not coordinated; give each host its share via LLM_REQUESTS_PER_MINUTE.
+    If LLM_FAKE_URL is set, requests are sent to a local fake server instead
+    (see utils/fake_llm_server.py).
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model: str = DEFAULT_MODEL,
+        temperature: float = 0,
+        requests_per_minute: int = 15,
+        max_concurrency: int = 4,
+        timeout: float = 60.0,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        token_budget: int = 0,
+        input_cost_per_m: float = 0.075,
+        output_cost_per_m: float = 0.30,
+        fake_url: Optional[str] = None,
+        state_dir: Optional[str] = None,
+    ):
+        self.api_key = api_key
+        self.model = model
+        self.temperature = temperature
+        self.requests_per_minute = requests_per_minute
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_budget = token_budget
+        self.input_cost_per_m = input_cost_per_m
+        self.output_cost_per_m = output_cost_per_m
+        self.fake_url = fake_url
+        self.jobs: Dict[str, JobUsage] = {}
+        self._llm = None
+        # Rate limit state is per model, since quotas are per model
+        self.state_dir = os.path.join(
+            state_dir or os.path.join(tempfile.gettempdir(), "amazonanalyzer_llm"),
+            re.sub(r"[^a-zA-Z0-9_.-]", "_", model),
+        )
+        os.makedirs(self.state_dir, exist_ok=True)
+        # requests_per_minute <= 0 disables rate limiting (concurrency is still capped)
+        self._bucket = (
+            FileTokenBucket(self.state_dir, requests_per_minute, capacity=max_concurrency)
+            if requests_per_minute > 0
+            else None
+        )
+        # A slot is held at most `timeout` seconds, so older slot files are stale
+        self._slots = FileSemaphore(
+            self.state_dir, max_concurrency, stale_after=timeout + 30
+        )
+
+    def _get_llm(self):
+        if self._llm is None:
+            from langchain_google_genai import ChatGoogleGenerativeAI
+
+            # Retries are handled here, so keep the SDK's own retry loop short
+            self._llm = ChatGoogleGenerativeAI(
+                model=self.model,
+                google_api_key=self.api_key,
+                temperature=self.temperature,
+                max_retries=1,
+            )
+        return self._llm
+
+    def usage(self, job_id: str) -> JobUsage:
+        if job_id not in self.jobs:
+            self.jobs[job_id] = JobUsage()
+        return self.jobs[job_id]
+
+    def pop_usage(self, job_id: str) -> JobUsage:
+        """Return a job's usage and stop tracking it."""
+        return self.jobs.pop(job_id, None) or JobUsage()
+
+    def _is_retryable(self, error: Exception) -> bool:
+        if isinstance(error, asyncio.TimeoutError):
+            return True
+        if isinstance(error, urllib.error.HTTPError):
+            return error.code == 429 or error.code >= 500
+        if isinstance(error, urllib.error.URLError):
+            return True
+        if type(error).__name__ in RETRYABLE_ERRORS:
+            return True
+        message = str(error).lower()
+        return "429" in message or "quota" in message or "rate limit" in message
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Exponential backoff with full jitter."""
+        ceiling = min(self.backoff_max, self.backoff_base * (2**attempt))
+        return random.uniform(0, ceiling)
+
+    def _call_fake(self, prompt_text: str) -> Dict:
+        payload = json.dumps({"model": self.model, "prompt": prompt_text}).encode(
+            "utf-8"
+        )
+        request = urllib.request.Request(
+            self.fake_url,
+            data=payload,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    async def _call_once(self, prompt: PromptValue):
+        """Perform a single model call and return (text, input_tokens, output_tokens)."""
+        prompt_text = prompt.to_string()
+        if self.fake_url:
+            body = await asyncio.to_thread(self._call_fake, prompt_text)
+            text = body.get("text", "")
+            usage = body.get("usage") or {}
+        else:
+            message = await self._get_llm().ainvoke(prompt)
+            text = message.content if isinstance(message.content, str) else ""
+            usage = getattr(message, "usage_metadata", None) or {}
+        input_tokens = usage.get("input_tokens") or estimate_tokens(prompt_text)
+        output_tokens = usage.get("output_tokens") or estimate_tokens(text)
+        return text, input_tokens, output_tokens
+
+    async def ainvoke(self, prompt: PromptValue, job_id: str = "default") -> str:
+        """Send a formatted prompt to the model and return the response text."""
+        job = self.usage(job_id)
+        if self.token_budget and job.total_tokens >= self.token_budget:
+            raise LLMBudgetExceeded(
+                f"Job {job_id} exceeded its token budget of {self.token_budget}"
+            )
+
+        attempt = 0
+        while True:
+            if self._bucket:
+                await self._bucket.acquire()
+            slot = await self._slots.acquire()
+            try:
+                with LLM_LATENCY.time(model=self.model):
+                    text, input_tokens, output_tokens = await asyncio.wait_for(
+                        self._call_once(prompt), timeout=self.timeout
+                    )
+            except Exception as e:
+                # Free the slot before backing off so other processes can proceed
+                slot.release()
+                job.errors += 1
+                LLM_ERRORS.inc(model=self.model, error=type(e).__name__)
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    print(
+                        f"[ERROR] LLM call failed for job {job_id}: {type(e).__name__}: {e}",
+                        file=sys.stderr,
+                    )
+                    raise
+                delay = self._backoff_delay(attempt)
+                print(
+                    f"[WARN] LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s "
+                    f"(attempt {attempt + 1}/{self.max_retries})",
+                    file=sys.stderr,
+                )
+                job.retries += 1
+                LLM_RETRIES.inc(model=self.model)
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancellation: still give the slot back
+                slot.release()
+                raise
+            slot.release()
+
+            job.calls += 1
+            LLM_CALLS.inc(model=self.model)
+            LLM_TOKENS.inc(input_tokens, model=self.model, direction="input")
+            LLM_TOKENS.inc(output_tokens, model=self.model, direction="output")
+            job.input_tokens += input_tokens
+            job.output_tokens += output_tokens
+            job.cost_usd += (
+                input_tokens * self.input_cost_per_m
+                + output_tokens * self.output_cost_per_m
+            ) / 1_000_000
+            return text
+
+
+_shared_client: Optional[AsyncLLMClient] = None
+
+
+def get_llm_client() -> AsyncLLMClient:
+    """Return the process-wide LLM client, configured from environment variables."""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = AsyncLLMClient(
+            api_key=os.getenv("GOOGLE_API_KEY"),
+            model=os.getenv("LLM_MODEL", DEFAULT_MODEL),
+            requests_per_minute=_env_int("LLM_REQUESTS_PER_MINUTE", 15),
+            max_concurrency=_env_int("LLM_MAX_CONCURRENCY", 4),
+            timeout=_env_float("LLM_TIMEOUT_SECONDS", 60.0),
+            max_retries=_env_int("LLM_MAX_RETRIES", 5),
+            backoff_base=_env_float("LLM_BACKOFF_BASE", 1.0),
+            backoff_max=_env_float("LLM_BACKOFF_MAX", 30.0),
+            token_budget=_env_int("LLM_TOKEN_BUDGET", 0),
+            input_cost_per_m=_env_float("LLM_INPUT_COST_PER_M", 0.075),
+            output_cost_per_m=_env_float("LLM_OUTPUT_COST_PER_M", 0.30),
+            fake_url=os.getenv("LLM_FAKE_URL"),
+            state_dir=os.getenv("LLM_RATE_LIMIT_DIR"),
+        )
+    return _shared_client
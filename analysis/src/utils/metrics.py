@@ -0,0 +1,285 @@
+"""In-process metrics for the analysis service, exported in Prometheus text format.
+
+Long-running processes (workers, prewarm.py) can serve them over HTTP with
+start_metrics_server(). One-shot CLI runs add their metrics to a shared file
+with dump_metrics() (compatible with the node_exporter textfile collector).
+The file accumulates across processes, so counters keep increasing.
+"""
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from utils.file_lock import FileLock
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonically increasing counter with optional labels."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, float]]:
+        with self.lock:
+            return [
+                (f"{self.name}{_format_labels(self.labelnames, key)}", value)
+                for key, value in sorted(self.values.items())
+            ]
+
+
+class Histogram:
+    """Histogram of observed values (e.g. latencies in seconds) with optional labels."""
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket counts..., sum, count]
+        self.values: Dict[Tuple, List[float]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            series = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall-clock duration of the enclosed block."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> List[Tuple[str, float]]:
+        samples = []
+        with self.lock:
+            for key, series in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    samples.append((f"{self.name}_bucket{labels}", count))
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                samples.append((f"{self.name}_bucket{labels}", series[-1]))
+                labels = _format_labels(self.labelnames, key)
+                samples.append((f"{self.name}_sum{labels}", series[-2]))
+                samples.append((f"{self.name}_count{labels}", series[-1]))
+        return samples
+
+
+def _sample_metric_name(sample: str) -> str:
+    name = sample.split("{", 1)[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def parse_samples(text: str) -> Dict[str, float]:
+    """Parse sample lines of a file written by MetricsRegistry.render()."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        sample, _, value = line.rpartition(" ")
+        try:
+            samples[sample] = float(value)
+        except ValueError:
+            continue
+    return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def samples(self) -> Dict[str, float]:
+        samples = {}
+        for metric in self.metrics:
+            samples.update(metric.samples())
+        return samples
+
+    def render(self, samples: Optional[Dict[str, float]] = None) -> str:
+        """Render the registry, or the given samples grouped under the registry's metrics."""
+        if samples is None:
+            samples = self.samples()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(
+                f"{sample} {value}"
+                for sample, value in samples.items()
+                if _sample_metric_name(sample) == metric.name
+            )
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+ANALYSIS_JOBS = REGISTRY.register(
+    Counter("analysis_jobs_total", "Analysis jobs by final status", ["status"])
+)
+STAGE_LATENCY = REGISTRY.register(
+    Histogram(
+        "analysis_stage_duration_seconds",
+        "Duration of analysis stages (graph nodes, embeddings, whole job)",
+        ["stage"],
+    )
+)
+EMBEDDINGS_COMPUTED = REGISTRY.register(
+    Counter(
+        "embeddings_computed_total",
+        "Documents embedded into vectorstores",
+        ["index_type"],
+    )
+)
+VECTORSTORE_CACHE = REGISTRY.register(
+    Counter(
+        "vectorstore_cache_total",
+        "Vectorstore lookups in generate_embeddings by result (hit = already built)",
+        ["index_type", "result"],
+    )
+)
+QUERY_EMBEDDING_CACHE = REGISTRY.register(
+    Counter(
+        "query_embedding_cache_total",
+        "Aspect query embedding lookups by result",
+        ["result"],
+    )
+)
+INDEX_LOADS = REGISTRY.register(
+    Counter("faiss_index_loads_total", "FAISS index loads by result", ["result"])
+)
+INDEX_LOAD_LATENCY = REGISTRY.register(
+    Histogram("faiss_index_load_duration_seconds", "Time spent loading FAISS indexes")
+)
+MONGO_QUERIES = REGISTRY.register(
+    Counter("mongo_queries_total", "MongoDB queries by collection", ["collection"])
+)
+LLM_CALLS = REGISTRY.register(
+    Counter("llm_calls_total", "Completed LLM calls", ["model"])
+)
+LLM_ERRORS = REGISTRY.register(
+    Counter("llm_errors_total", "Failed LLM attempts by error type", ["model", "error"])
+)
+LLM_RETRIES = REGISTRY.register(
+    Counter("llm_retries_total", "LLM attempts that were retried", ["model"])
+)
+LLM_TOKENS = REGISTRY.register(
+    Counter("llm_tokens_total", "LLM tokens used", ["model", "direction"])
+)
+LLM_LATENCY = REGISTRY.register(
+    Histogram("llm_call_duration_seconds", "Duration of LLM attempts", ["model"])
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int, host: str = "localhost") -> ThreadingHTTPServer:
+    """Serve /metrics on a background thread for the lifetime of the process."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"[METRICS] Serving metrics on http://{host}:{port}/metrics", file=sys.stderr)
+    return server
+
+
+# Samples already added to the metrics file by this process
+_dumped_samples: Dict[str, float] = {}
+
+
+def dump_metrics(path: Optional[str]):
+    """Add this process's metrics to the Prometheus text file at `path`.
+
+    Samples are summed with what other processes already wrote, under a lock
+    file, so the file holds totals across all analysis runs. Only the change
+    since this process's previous dump is added, so calling it repeatedly is safe.
+    """
+    if not path:
+        return
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        current = REGISTRY.samples()
+        with FileLock(f"{path}.lock", stale_after=10):
+            merged = {}
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    merged = parse_samples(f.read())
+            for sample, value in current.items():
+                delta = value - _dumped_samples.get(sample, 0)
+                merged[sample] = merged.get(sample, 0) + delta
+            tmp_path = f"{path}.tmp.{os.getpid()}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(REGISTRY.render(merged))
+            os.replace(tmp_path, path)
+        _dumped_samples.update(current)
+    except Exception as e:
+        print(f"[METRICS] Failed to write metrics to {path}: {e}", file=sys.stderr)
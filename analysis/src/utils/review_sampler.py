@@ -0,0 +1,142 @@
+"""Stratified review sampling to bound embedding cost for products with many reviews."""
+
+import math
+import os
+import random
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+# Per-ASIN review cap (0 = keep all reviews) and seed for deterministic sampling
+DEFAULT_MAX_REVIEWS = 300
+DEFAULT_SAMPLE_SEED = 42
+
+DATE_FORMATS = ["%B %d, %Y", "%d %B %Y", "%Y-%m-%d"]
+
+
+def get_sampling_config() -> Tuple[int, int]:
+    """Return (max_reviews, seed) from REVIEW_SAMPLE_LIMIT / REVIEW_SAMPLE_SEED.
+    Negative limits are treated as 0 (sampling disabled)."""
+    try:
+        max_reviews = int(os.getenv("REVIEW_SAMPLE_LIMIT", DEFAULT_MAX_REVIEWS))
+    except ValueError:
+        max_reviews = DEFAULT_MAX_REVIEWS
+    try:
+        seed = int(os.getenv("REVIEW_SAMPLE_SEED", DEFAULT_SAMPLE_SEED))
+    except ValueError:
+        seed = DEFAULT_SAMPLE_SEED
+    return max(0, max_reviews), seed
+
+
+def parse_review_date(value) -> Optional[datetime]:
+    """Parse the scraped review date ("March 3, 2024"); returns None if unknown."""
+    if isinstance(value, datetime):
+        return value
+    if not value or not isinstance(value, str):
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def _allocate(sizes: Dict, total: int) -> Dict:
+    """Split `total` slots across strata proportionally (largest remainder method)."""
+    population = sum(sizes.values())
+    quotas = {key: size * total / population for key, size in sizes.items()}
+    allocation = {key: int(math.floor(q)) for key, q in quotas.items()}
+    remaining = total - sum(allocation.values())
+    for key in sorted(quotas, key=lambda k: quotas[k] - allocation[k], reverse=True):
+        if remaining <= 0:
+            break
+        if allocation[key] < sizes[key]:
+            allocation[key] += 1
+            remaining -= 1
+    return allocation
+
+
+def _review_id(review: Dict) -> str:
+    """Final sort key, since Mongo's natural order can change between rebuilds."""
+    return str(review.get("review_id") or review.get("_id") or "")
+
+
+def _select_from_stratum(reviews: List[Dict], count: int, rng: random.Random) -> List[Dict]:
+    """Pick `count` reviews: half the slots go to the most helpful reviews, the rest
+    are spread evenly over time (systematic sampling with a seeded offset)."""
+    if count >= len(reviews):
+        return list(reviews)
+    if count <= 0:
+        return []
+
+    by_helpfulness = sorted(
+        reviews, key=lambda r: (-(r.get("helpful_votes") or 0), _review_id(r))
+    )
+    helpful_count = count // 2
+    selected = [r for r in by_helpfulness[:helpful_count] if (r.get("helpful_votes") or 0) > 0]
+    selected_ids = {id(r) for r in selected}
+
+    rest = [r for r in reviews if id(r) not in selected_ids]
+    rest.sort(
+        key=lambda r: (parse_review_date(r.get("date")) or datetime.min, _review_id(r))
+    )
+    needed = count - len(selected)
+    step = len(rest) / needed
+    offset = rng.random() * step
+    selected.extend(rest[int(offset + i * step)] for i in range(needed))
+    return selected
+
+
+def _rating_bucket(review: Dict) -> str:
+    rating = review.get("rating")
+    if rating is None:
+        return "unrated"
+    return str(int(round(rating)))
+
+
+def sample_reviews(
+    reviews_by_type: Dict[str, List[Dict]],
+    max_reviews: int,
+    seed: int,
+    asin: str,
+) -> Tuple[Dict[str, List[Dict]], Dict]:
+    """Cap the reviews of one ASIN at `max_reviews`, stratified by review type and rating.
+
+    Returns the sampled reviews (same shape as the input) and sampling stats
+    with the total and sampled counts per review type.
+    """
+    total = sum(len(reviews) for reviews in reviews_by_type.values())
+    if max_reviews <= 0 or total <= max_reviews:
+        stats = {
+            review_type: {"total": len(reviews), "sampled": len(reviews), "ratio": 1.0}
+            for review_type, reviews in reviews_by_type.items()
+        }
+        return reviews_by_type, {
+            "max_reviews": max_reviews,
+            "seed": seed,
+            "by_type": stats,
+        }
+
+    strata = defaultdict(list)
+    for review_type, reviews in reviews_by_type.items():
+        for review in reviews:
+            strata[(review_type, _rating_bucket(review))].append(review)
+
+    allocation = _allocate({key: len(items) for key, items in strata.items()}, max_reviews)
+    # Seeding per ASIN keeps samples stable across rebuilds
+    rng = random.Random(f"{seed}:{asin}")
+
+    sampled = {review_type: [] for review_type in reviews_by_type}
+    for key in sorted(strata):
+        sampled[key[0]].extend(_select_from_stratum(strata[key], allocation[key], rng))
+
+    stats = {}
+    for review_type, reviews in reviews_by_type.items():
+        kept = len(sampled[review_type])
+        stats[review_type] = {
+            "total": len(reviews),
+            "sampled": kept,
+            "ratio": round(kept / len(reviews), 4) if reviews else 1.0,
+        }
+    return sampled, {"max_reviews": max_reviews, "seed": seed, "by_type": stats}
@@ -172,7 +172,11 @@ const createAnalysis = async (req, res) => {
     ], {
       env: {
         ...process.env,
-        PYTHONUTF8: '1'
+        PYTHONUTF8: '1',
+        // Accumulate analysis metrics across runs (Prometheus textfile format)
+        ANALYSIS_METRICS_FILE:
+          process.env.ANALYSIS_METRICS_FILE ||
+          path.resolve(__dirname, "../../analysis/metrics/analysis.prom")
       }
     });
 